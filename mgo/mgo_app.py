@@ -27,12 +27,12 @@ def get_village_list():
 @app.route('/_run_model')
 def run_model():
     # load the relevant buildings file
-    buildings = mgo.load_buildings(village=request.args.get('name', 0, type=str),
-                                   file_dir=uploads,
-                                   min_area=request.args.get('min_area', 0, type=int))
+    buildings, buildings_projected = mgo.load_buildings(village=request.args.get('name', 0, type=str),
+                                                        file_dir=uploads,
+                                                        min_area=request.args.get('min_area', 0, type=int))
 
     # create the network and nodes for this village
-    network, nodes = mgo.create_network(buildings,
+    network, nodes = mgo.create_network(buildings_projected,
                                         gen_lat=request.args.get('gen_lat', 0, type=float),
                                         gen_lng=request.args.get('gen_lng', 0, type=float))
 